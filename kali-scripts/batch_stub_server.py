@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# batch_stub_server.py – local stand-in for the wifi-capture 'batch' and 'process' actions
+# Purpose: Reproduce the gzip/delta upload round trip (upload_encoding.py) without Supabase
+#
+# Run as a server and point a capture script at it:
+#   python3 batch_stub_server.py                 # listens on http://127.0.0.1:8000
+#   SUPABASE_URL=http://127.0.0.1:8000 sudo -E python3 capture_sender.py
+#
+# Or run the built-in round trip (encode -> decode -> expand, including a 'process'
+# that clears stored rows and the resend of missing devices):
+#   python3 batch_stub_server.py --demo
+
+import gzip
+import json
+import random
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from upload_encoding import DeltaEncoder
+
+HOST = "127.0.0.1"
+PORT = 8000
+
+# Columns the edge function copies when expanding an unchanged device
+STORED_FIELDS = ("ap_id", "rssi", "rssi_std", "invalid_rssi_count",
+                 "frag_count", "bytes_total", "frame_count", "data_frames", "mgmt_frames")
+
+store_lock = threading.Lock()
+captures = []  # rows as inserted into periodic_captures, oldest first
+
+def to_row(device):
+    """Mirror the edge function's payload -> periodic_captures mapping"""
+    rssi = device.get("rssi")
+    if rssi is None:
+        rssi = device.get("rssi_mean", -99)
+    row = {field: device.get(field) for field in STORED_FIELDS}
+    row.update({"device_id": device["device_id"], "ap_id": device.get("ap_id") or "DefaultAP", "rssi": rssi})
+    return row
+
+def handle_batch(batch):
+    """Insert full devices, expand unchanged ids from their latest row, report missing ids"""
+    with store_lock:
+        latest = {row["device_id"]: row for row in captures}
+        rows = [to_row(d) for d in batch.get("devices", []) if d.get("device_id")]
+        missing = []
+        for device_id in batch.get("unchanged", []):
+            prev = latest.get(device_id)
+            if prev:
+                rows.append(dict(prev))
+            else:
+                missing.append(device_id)
+        captures.extend(rows)
+    return {"message": "Batch recorded", "inserted": len(rows),
+            "expanded": len(batch.get("unchanged", [])) - len(missing), "missing": missing}
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        action = self.path.rstrip("/").split("/")[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if body[:2] == b"\x1f\x8b":
+            body = gzip.decompress(body)
+
+        if action == "batch":
+            batch = json.loads(body)
+            if not isinstance(batch.get("devices"), list) or not isinstance(batch.get("unchanged"), list):
+                self.reply(400, {"error": "Invalid batch data"})
+                return
+            result = handle_batch(batch)
+            print(f"[STUB] {'keyframe' if batch.get('keyframe') else 'delta'} window {batch.get('window')}: "
+                  f"{len(batch['devices'])} full, {result['expanded']} expanded, {len(result['missing'])} missing")
+            self.reply(200, result)
+        elif action == "process":
+            with store_lock:
+                count = len(captures)
+                captures.clear()
+            self.reply(200, {"message": f"Processed {count} records", "records": count})
+        else:
+            self.reply(400, {"error": "Invalid action"})
+
+def start_server():
+    server = HTTPServer((HOST, PORT), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def window_payload(rng, mac, profile, clock_minute, sample_rate):
+    """One window's summary as capture_sender.summarize_session shapes it, with count noise"""
+    rate, bytes_per_frame, rssi = profile
+    frames = max(1, round(rng.gauss(rate, rate ** 0.5)))  # roughly Poisson frame counts
+    data = round(frames * rng.uniform(0.6, 0.8)) if rate > 20 else rng.randint(0, 1)
+    return {
+        "device_id": mac,
+        "login_hour": clock_minute // 60 % 24,
+        "weekday": 2,
+        "duration_total": round(rng.uniform(24.0, 29.9), 2),
+        "start_minute_of_day": clock_minute % 1440,
+        "ap_switches": 0,
+        "frag_count": rng.randint(0, 3) if rate > 20 else 0,
+        "bytes_total": sum(max(24, round(rng.gauss(bytes_per_frame, 40))) for _ in range(frames)),
+        "rssi_mean": round(rssi + rng.uniform(-1.2, 1.2), 2),
+        "rssi_std": round(rng.uniform(1.0, 3.0), 2),
+        "invalid_rssi_count": rng.randint(0, 2),
+        "frame_count": frames,
+        "data_frames": data,
+        "mgmt_frames": frames - data,
+        "sample_rate": sample_rate
+    }
+
+def demo():
+    """Drive DeltaEncoder against the stub and check every device gets a row each window"""
+    base_url = f"http://{HOST}:{PORT}/functions/v1/wifi-capture"
+    encoder = DeltaEncoder(keyframe_interval=5)
+    rng = random.Random(0)
+    # (frames per window, bytes per frame, rssi): mostly idle phones probing, a few busy ones
+    profiles = {f"aa:bb:cc:00:00:{i:02x}": (6 if i % 8 else 300, 180 if i % 8 else 900,
+                                           -60 + rng.randint(-10, 10)) for i in range(40)}
+    headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+
+    for window in range(8):
+        clock_minute = 9 * 60 + 59 + window // 2  # 30 s windows crossing the hour
+        sample_rate = 1.0 if window < 6 else 0.5
+        payloads = [window_payload(rng, mac, profile, clock_minute, sample_rate)
+                    for mac, profile in profiles.items()]
+        if window == 3:
+            payloads[0]["rssi_mean"] -= 10  # one device moves
+        if window == 4:
+            requests.post(f"{base_url}/process", timeout=5)  # clears stored rows
+
+        before = len(captures)
+        body, info = encoder.encode(payloads)
+        result = requests.post(f"{base_url}/batch", data=body, headers=headers, timeout=5).json()
+        missing = set(result["missing"])
+        if missing:
+            body, _ = encoder.encode_resend([p for p in payloads if p["device_id"] in missing])
+            requests.post(f"{base_url}/batch", data=body, headers=headers, timeout=5)
+
+        rows = len(captures) - before
+        print(f"[DEMO] window {window}: {info['full']} full / {info['unchanged']} unchanged, "
+              f"{info['gzip_bytes']} B gzip ({info['raw_bytes']} B raw), "
+              f"{rows} rows stored, {len(missing)} resent")
+        assert rows == len(profiles), "every device must get a row every window"
+        if not info["keyframe"] and not missing:
+            assert info["full"] <= len(profiles) // 4, "count noise must not force resends"
+    print("[DEMO] OK")
+
+if __name__ == "__main__":
+    server = start_server()
+    if "--demo" in sys.argv:
+        demo()
+        server.shutdown()
+    else:
+        print(f"[STUB] wifi-capture stub on http://{HOST}:{PORT} (Ctrl+C to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -4,14 +4,16 @@
 # Purpose: Capture Wi-Fi packets, compute session features, and POST to Supabase edge function
 
 import requests
-from scapy.all import sniff, Dot11, RadioTap
+from scapy.all import conf, Dot11, RadioTap
 from datetime import datetime
-from statistics import mean, pstdev
 import threading
 import time
 import json
 import os
+import socket
+import zlib
 from dotenv import load_dotenv
+from upload_encoding import DeltaEncoder, make_thresholds
 
 # Load env
 load_dotenv()
@@ -23,15 +25,39 @@ CAPTURE_IFACE = os.getenv("CAPTURE_IFACE", "wlan0mon")
 CAPTURE_WINDOW = int(os.getenv("CAPTURE_WINDOW", "30"))   # seconds per batch
 SEND_INTERVAL = int(os.getenv("SEND_INTERVAL", "30"))     # seconds per send (same as window)
 CONTROL_POLL_INTERVAL = int(os.getenv("CONTROL_POLL_INTERVAL", "5"))  # seconds
+# Adaptive load shedding: sample frames when the capture thread exceeds its CPU budget
+SAMPLING_ENABLED = os.getenv("SAMPLING_ENABLED", "1") == "1"
+CAPTURE_CPU_BUDGET = float(os.getenv("CAPTURE_CPU_BUDGET", "0.7"))   # fraction of one core
+RX_QUEUE_HIGH = int(os.getenv("RX_QUEUE_HIGH", "1048576"))            # bytes queued on capture socket
+SAMPLE_RATE_MIN = float(os.getenv("SAMPLE_RATE_MIN", "0.05"))
+LOAD_CHECK_INTERVAL = float(os.getenv("LOAD_CHECK_INTERVAL", "1"))    # seconds
+# Batched uploads: one gzip request per window, unchanged devices sent by id only
+UPLOAD_BATCH = os.getenv("UPLOAD_BATCH", "1") == "1"
+KEYFRAME_INTERVAL = int(os.getenv("KEYFRAME_INTERVAL", "10"))  # windows between full uploads
+DELTA_RSSI_DB = float(os.getenv("DELTA_RSSI_DB", "3"))         # RSSI change that forces a resend
+DELTA_COUNT_REL = float(os.getenv("DELTA_COUNT_REL", "0.5"))   # relative change for frame/byte counts
 # ------------------
 
 if not SUPABASE_KEY:
     raise SystemExit("[ERROR] SUPABASE_KEY not set. Add to .env")
+if KEYFRAME_INTERVAL < 1:
+    raise SystemExit("[ERROR] KEYFRAME_INTERVAL must be >= 1")
 
-lock = threading.Lock()
-packet_buffer = {}  # device_id -> list of packets (RSSI, AP, timestamp)
+lock = threading.Lock()  # guards the per-window buffers; held only briefly by the capture thread
+upload_lock = threading.Lock()  # serializes uploads and upload_encoder state
+packet_buffer = {}  # device_id -> list of kept packets (RSSI, AP, timestamp, frame header fields)
+device_presence = {}  # device_id -> first/last seen, AP set and frame count over ALL frames (pre-sampling)
 capture_active = False
 network_error_logged = False
+capture_stats = {"frames": 0, "kept": 0, "malformed": 0, "errors": 0, "cpu_ns": 0}  # cumulative; cpu_ns is the capture thread's CPU time
+sampling = {"rate": 1.0, "supported": False}  # fraction of frames dissected; each sampled frame weighs 1/rate
+upload_encoder = DeltaEncoder(KEYFRAME_INTERVAL, make_thresholds(DELTA_RSSI_DB, DELTA_COUNT_REL))
+
+# 802.11 frame types (Frame Control bits 2-3)
+DOT11_TYPE_MGMT = 0
+DOT11_TYPE_CTRL = 1
+DOT11_TYPE_DATA = 2
+DOT11_FLAG_MORE_FRAG = 0x04
 
 def parse_rssi(pkt):
     """Parse RSSI from packet - try multiple methods with fallbacks"""
@@ -92,8 +118,120 @@ def parse_rssi(pkt):
     
     return None
 
-def handler(pkt):
-    # handler runs for every packet sniffed; only buffer when capture_active True
+def parse_frame_header(pkt):
+    """Read frame length, type and fragment fields straight from the raw bytes.
+
+    Scapy attribute lookups (pkt[Dot11].SC, len(pkt)) cost several µs each and
+    len(pkt) rebuilds the whole frame, so we index the captured buffer instead:
+    RadioTap header length, then the 802.11 Frame Control and Sequence Control.
+    Returns (frame_len, frame_type, frag_num, more_frag) or None if unavailable.
+    """
+    # Offsets below assume a RadioTap header (same case parse_rssi() falls back on)
+    if not isinstance(pkt, RadioTap):
+        return None
+    raw = pkt.original
+    if not raw or len(raw) < 4:
+        return None
+    rt_len = raw[2] | (raw[3] << 8)
+    if len(raw) < rt_len + 2:
+        return None
+    frame_type = (raw[rt_len] >> 2) & 0x03
+    more_frag = bool(raw[rt_len + 1] & DOT11_FLAG_MORE_FRAG)
+    frag_num = 0
+    # Control frames carry no Sequence Control field
+    if frame_type != DOT11_TYPE_CTRL and len(raw) >= rt_len + 24:
+        frag_num = raw[rt_len + 22] & 0x0F
+    return len(raw) - rt_len, frame_type, frag_num, more_frag
+
+def raw_addresses(raw):
+    """(transmitter, receiver) MACs from raw RadioTap frame bytes, or None.
+
+    ACK/CTS carry no transmitter address and are skipped, as in handler().
+    """
+    if len(raw) < 4:
+        return None
+    rt_len = raw[2] | (raw[3] << 8)
+    if len(raw) < rt_len + 16:
+        return None
+    return raw[rt_len + 10:rt_len + 16].hex(":"), raw[rt_len + 4:rt_len + 10].hex(":")
+
+def sample_keep(raw, rate):
+    """Deterministic per-device sampling on a hash of transmitter MAC + Sequence Control.
+
+    Runs on the raw RadioTap bytes before dissection so shed frames stay cheap.
+    Retransmissions share the same key and are kept or dropped together.
+    """
+    rt_len = raw[2] | (raw[3] << 8)
+    key = raw[rt_len + 10:rt_len + 16] + raw[rt_len + 22:rt_len + 24]
+    return zlib.crc32(key) < rate * 0x100000000
+
+# RadioTap fields preceding dBm_AntSignal (bit 5): (alignment, size) for bits 0-4
+RADIOTAP_FIELDS_BEFORE_SIGNAL = ((8, 8), (1, 1), (1, 1), (2, 4), (2, 2))
+
+def raw_rssi(raw):
+    """dBm_AntSignal from raw RadioTap bytes, or None if absent.
+
+    Only the first antenna's value is read; drivers that need parse_rssi()'s
+    fallbacks simply yield None here.
+    """
+    present = int.from_bytes(raw[4:8], "little")
+    if not present & (1 << 5):
+        return None
+    offset = 8
+    word = present
+    while word & (1 << 31):  # extended present bitmaps
+        word = int.from_bytes(raw[offset:offset + 4], "little")
+        offset += 4
+    for bit, (align, size) in enumerate(RADIOTAP_FIELDS_BEFORE_SIGNAL):
+        if present & (1 << bit):
+            offset = (offset + align - 1) & ~(align - 1)
+            offset += size
+    if offset >= (raw[2] | (raw[3] << 8)):
+        return None
+    value = raw[offset]
+    return value - 256 if value >= 128 else value
+
+def note_presence(mac, ap, ts, raw=None):
+    """Update the device's presence record (caller holds lock); cheap enough for every frame"""
+    presence = device_presence.get(mac)
+    if presence is None:
+        # One RSSI reading per device per window, for devices no sampled frame covers
+        rssi = raw_rssi(raw) if raw is not None else None
+        device_presence[mac] = {"first": ts, "last": ts, "aps": {ap}, "frames": 1, "rssi": rssi}
+        return
+    presence["last"] = ts
+    presence["aps"].add(ap)
+    presence["frames"] += 1
+
+def capture_frame(cls, raw):
+    """Per-frame entry point: presence and sampling on the raw bytes, then dissect kept frames"""
+    if not capture_active:
+        return
+    weight = 1.0
+    if cls is RadioTap:
+        addrs = raw_addresses(raw)
+        if addrs is None:
+            return
+        mac, ap = addrs
+        if mac.startswith("ff:"):
+            return
+        with lock:
+            note_presence(mac, ap, time.time(), raw)
+        rate = sampling["rate"]
+        if rate < 1.0:
+            if not sample_keep(raw, rate):
+                return
+            weight = 1.0 / rate
+    # Guard dissection like SuperSocket.recv(): malformed frames (common in floods) are skipped
+    try:
+        pkt = cls(raw)
+    except Exception:
+        capture_stats["malformed"] += 1
+        return
+    handler(pkt, weight)
+
+def handler(pkt, weight=1.0):
+    # handler runs for every dissected packet; only buffer when capture_active True
     if not capture_active:
         return
         
@@ -105,43 +243,151 @@ def handler(pkt):
         return
 
     rssi = parse_rssi(pkt)
+    header = parse_frame_header(pkt)
     ts = time.time()
 
     # store packet
     with lock:
+        # RadioTap frames were already counted by capture_frame() before dissection
+        if not isinstance(pkt, RadioTap):
+            note_presence(mac, ap, ts)
         if mac not in packet_buffer:
             packet_buffer[mac] = []
         packet_buffer[mac].append({
             "ap": ap,
             "rssi": rssi,
-            "timestamp": ts
+            "timestamp": ts,
+            "length": header[0] if header else 0,
+            "type": header[1] if header else None,
+            "frag": header[2] if header else 0,
+            "more_frag": header[3] if header else False,
+            "weight": weight
         })
+        capture_stats["kept"] += 1
+
+def capture_loop():
+    """Read raw frames from CAPTURE_IFACE and hand them to capture_frame().
 
-def summarize_session(device_id, records):
+    Used instead of sniff(prn=handler): scapy dissects every frame before prn runs,
+    and dissection costs ~10x handler() itself, so shedding must happen on the bytes.
+    Publishes this thread's CPU time so load_monitor() sees the real capture cost.
+    """
+    sock = conf.L2listen(iface=CAPTURE_IFACE)
+    # Sampling reads RadioTap offsets from the raw bytes; other link types are never shed
+    sampling["supported"] = sock.LL is RadioTap
+    if SAMPLING_ENABLED and not sampling["supported"]:
+        print(f"[LOAD] Link type {getattr(sock.LL, '__name__', sock.LL)} has no RadioTap header - load shedding disabled")
+    try:
+        while True:
+            cls, raw, _ = sock.recv_raw()
+            if raw is not None:
+                try:
+                    capture_frame(cls, raw)
+                except Exception as e:
+                    # One bad frame must not end capture
+                    capture_stats["errors"] += 1
+                    if not hasattr(capture_loop, '_error_printed'):
+                        print(f"[DEBUG] Frame processing error: {e}")
+                        capture_loop._error_printed = True
+                capture_stats["frames"] += 1
+            capture_stats["cpu_ns"] = time.thread_time_ns()
+    finally:
+        sock.close()
+
+def read_rx_queue_bytes():
+    """Bytes waiting in the kernel receive queue of packet sockets on CAPTURE_IFACE"""
+    try:
+        ifindex = socket.if_nametoindex(CAPTURE_IFACE)
+        with open("/proc/net/packet") as f:
+            next(f)  # header: sk RefCnt Type Proto Iface R Rmem User Inode
+            rows = [line.split() for line in f]
+        return sum(int(cols[6]) for cols in rows if int(cols[4]) == ifindex)
+    except (OSError, ValueError, IndexError, StopIteration):
+        return 0
+
+def load_monitor():
+    """Adjust the sampling rate from capture thread CPU share and capture socket backlog"""
+    last_busy = capture_stats["cpu_ns"]
+    last_wall = time.perf_counter_ns()
+    while True:
+        time.sleep(LOAD_CHECK_INTERVAL)
+        busy = capture_stats["cpu_ns"]
+        wall = time.perf_counter_ns()
+        cpu_share = (busy - last_busy) / max(wall - last_wall, 1)
+        last_busy, last_wall = busy, wall
+        if not capture_active or not sampling["supported"]:
+            continue
+
+        rx_queue = read_rx_queue_bytes()
+        rate = sampling["rate"]
+        if cpu_share > CAPTURE_CPU_BUDGET or rx_queue > RX_QUEUE_HIGH:
+            # Scale down towards the budget, at least halving when the queue is backing up
+            target = rate * CAPTURE_CPU_BUDGET / max(cpu_share, 1e-9)
+            if rx_queue > RX_QUEUE_HIGH:
+                target = min(target, rate * 0.5)
+            new_rate = max(SAMPLE_RATE_MIN, min(rate, target))
+        elif cpu_share < CAPTURE_CPU_BUDGET * 0.5 and rx_queue < RX_QUEUE_HIGH // 4:
+            new_rate = min(1.0, rate * 2)
+        else:
+            new_rate = rate
+
+        if new_rate != rate:
+            sampling["rate"] = new_rate
+            print(f"[LOAD] capture CPU {cpu_share:.0%}, rx queue {rx_queue} B → sample rate {rate:.2f} -> {new_rate:.2f}")
+
+def weighted_mean_std(values, weights):
+    """Horvitz-Thompson style mean and population std over inverse-probability weights"""
+    total = sum(weights)
+    m = sum(w * v for v, w in zip(values, weights)) / total
+    var = sum(w * (v - m) ** 2 for v, w in zip(values, weights)) / total
+    return m, var ** 0.5
+
+def summarize_session(device_id, records, presence):
     """Compute features used by AI model"""
-    if not records:
+    if not presence:
         return None
-    timestamps = [r["timestamp"] for r in records]
-    duration_total = max(timestamps) - min(timestamps)
-    ap_switches = len(set(r["ap"] for r in records))
-    rssi_values = [r["rssi"] for r in records if r["rssi"] is not None]
-    rssi_mean = mean(rssi_values) if rssi_values else -99
-    rssi_std = pstdev(rssi_values) if len(rssi_values) > 1 else 0
-    invalid_rssi_count = len([r for r in records if r["rssi"] is None])
+    # Presence covers every frame, sampled or not
+    duration_total = presence["last"] - presence["first"]
+    ap_switches = len(presence["aps"])
+    frame_count = presence["frames"]
+    # Per-frame sums are scaled by each record's inverse sampling rate (1.0 when not sampling)
+    valid = [r for r in records if r["rssi"] is not None]
+    rssi_values = [r["rssi"] for r in valid]
+    if len(rssi_values) > 1:
+        rssi_mean, rssi_std = weighted_mean_std(rssi_values, [r["weight"] for r in valid])
+    elif rssi_values:
+        rssi_mean = rssi_values[0]
+        rssi_std = 0
+    else:
+        # No sampled frame for this device: fall back on the raw reading from its first frame
+        rssi_mean = presence.get("rssi")
+        if rssi_mean is None:
+            rssi_mean = -99
+        rssi_std = 0
+    invalid_rssi_count = round(sum(r["weight"] for r in records if r["rssi"] is None))
+    bytes_total = round(sum(r["length"] * r["weight"] for r in records))
+    # A frame belongs to a fragmented MSDU if it is a non-first fragment or more follow
+    frag_count = round(sum(r["weight"] for r in records if r["frag"] > 0 or r["more_frag"]))
+    data_frames = round(sum(r["weight"] for r in records if r["type"] == DOT11_TYPE_DATA))
+    mgmt_frames = round(sum(r["weight"] for r in records if r["type"] == DOT11_TYPE_MGMT))
 
     now = datetime.now()
     payload = {
         "device_id": device_id,
         "duration_total": round(duration_total, 2),
         "ap_switches": ap_switches,
-        "frag_count": len(records),
-        "bytes_total": 0,
+        "frag_count": frag_count,
+        "bytes_total": bytes_total,
         "rssi_mean": round(rssi_mean, 2),
         "rssi_std": round(rssi_std, 2),
         "invalid_rssi_count": invalid_rssi_count,
         "login_hour": now.hour,
         "weekday": now.weekday(),
-        "start_minute_of_day": now.hour * 60 + now.minute
+        "start_minute_of_day": now.hour * 60 + now.minute,
+        "frame_count": frame_count,
+        "data_frames": data_frames,
+        "mgmt_frames": mgmt_frames,
+        "sample_rate": round(len(records) / frame_count, 3) if frame_count else 1.0
     }
     return payload
 
@@ -172,22 +418,98 @@ def send_to_supabase(payload):
     except Exception as e:
         print("[SEND] Exception:", e)
 
+def post_batch(body):
+    """POST a gzip batch body to 'wifi-capture' -> 'batch'; returns the JSON response or None"""
+    headers = {
+        'Content-Type': 'application/json',
+        'Content-Encoding': 'gzip',
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}'
+    }
+    url = SUPABASE_URL.rstrip('/') + "/functions/v1/wifi-capture/batch"
+
+    resp = requests.post(url, data=body, headers=headers, timeout=10)
+    if resp.status_code not in (200, 201):
+        print(f"[SEND] FAIL {resp.status_code}: {resp.text}")
+        return None
+    try:
+        return resp.json()
+    except Exception:
+        return {}
+
+def send_batch_to_supabase(payloads):
+    """
+    Sends one gzip batch for the window to 'wifi-capture' -> 'batch' path.
+    Devices whose summaries did not move are sent by id only (see upload_encoding.py);
+    any the server has no stored state for are resent in full in the same send.
+    """
+    try:
+        body, info = upload_encoder.encode(payloads)
+        result = post_batch(body)
+        if result is None:
+            upload_encoder.reset()
+            return
+        kind = "keyframe" if info["keyframe"] else "delta"
+        print(f"[SEND] OK → batch ({kind}): {info['full']} full, {info['unchanged']} unchanged, "
+              f"{info['gzip_bytes']} B gzip ({info['raw_bytes']} B raw)")
+
+        missing = set(result.get("missing") or [])
+        if missing:
+            body, info = upload_encoder.encode_resend([p for p in payloads if p["device_id"] in missing])
+            if post_batch(body) is None:
+                upload_encoder.reset()
+                return
+            print(f"[SEND] OK → resent {info['full']} devices unknown to server, {info['gzip_bytes']} B gzip")
+    except Exception as e:
+        print("[SEND] Exception:", e)
+        upload_encoder.reset()
+
+def take_buffers():
+    """Swap the window's buffers for fresh ones (caller holds lock) so uploads run unlocked"""
+    global packet_buffer, device_presence
+    records, presence = packet_buffer, device_presence
+    packet_buffer, device_presence = {}, {}
+    return records, presence
+
+def upload_summaries(records_by_device, presence_by_device):
+    """Summarize each device and upload, batched or one request per device"""
+    payloads = []
+    for device_id, presence in list(presence_by_device.items()):
+        features = summarize_session(device_id, records_by_device.get(device_id, []), presence)
+        if features:
+            payloads.append(features)
+    if not payloads:
+        return
+    with upload_lock:
+        if UPLOAD_BATCH:
+            send_batch_to_supabase(payloads)
+        else:
+            for features in payloads:
+                send_to_supabase(features)
+
 def periodic_sender():
     """Flush packet_buffer every SEND_INTERVAL seconds when capture is active"""
+    last_perf = dict(capture_stats)
     while True:
         time.sleep(SEND_INTERVAL)
         if not capture_active:
             continue
             
         with lock:
-            if not packet_buffer:
+            if not device_presence:
                 continue
-            print(f"\n[AGGREGATE] Processing {len(packet_buffer)} devices...")
-            for device_id, recs in list(packet_buffer.items()):
-                features = summarize_session(device_id, recs)
-                if features:
-                    send_to_supabase(features)
-            packet_buffer.clear()
+            print(f"\n[AGGREGATE] Processing {len(device_presence)} devices...")
+            frames = capture_stats["frames"] - last_perf["frames"]
+            if frames:
+                kept = capture_stats["kept"] - last_perf["kept"]
+                avg_us = (capture_stats["cpu_ns"] - last_perf["cpu_ns"]) / frames / 1000
+                bad = (capture_stats["malformed"] - last_perf["malformed"]) + (capture_stats["errors"] - last_perf["errors"])
+                print(f"[PERF] capture: {frames} frames, {kept} dissected, {bad} malformed/errors, "
+                      f"avg {avg_us:.1f} µs CPU/frame")
+            last_perf = dict(capture_stats)
+            records, presence = take_buffers()
+        # Network I/O happens outside lock so the capture thread never waits on it
+        upload_summaries(records, presence)
 
 def start_capture():
     """Start the capture process"""
@@ -195,6 +517,10 @@ def start_capture():
     with lock:
         capture_active = True
         packet_buffer.clear()
+        device_presence.clear()
+        sampling["rate"] = 1.0
+    with upload_lock:
+        upload_encoder.reset()
     print("[CAPTURE] Started WiFi capture - waiting for packets...")
 
 def stop_capture():
@@ -202,14 +528,11 @@ def stop_capture():
     global capture_active
     with lock:
         capture_active = False
-        # Send any remaining data before stopping
-        if packet_buffer:
-            print(f"[STOP] Sending final {len(packet_buffer)} devices...")
-            for device_id, recs in list(packet_buffer.items()):
-                features = summarize_session(device_id, recs)
-                if features:
-                    send_to_supabase(features)
-            packet_buffer.clear()
+        records, presence = take_buffers()
+    # Send any remaining data before stopping
+    if presence:
+        print(f"[STOP] Sending final {len(presence)} devices...")
+        upload_summaries(records, presence)
     print("[CAPTURE] Stopped WiFi capture")
 
 def cancel_capture():
@@ -218,6 +541,7 @@ def cancel_capture():
     with lock:
         capture_active = False
         packet_buffer.clear()
+        device_presence.clear()
     print("[CAPTURE] Cancelled WiFi capture - data cleared")
 
 # --- Control watcher: polls Supabase control RPC and triggers start/stop ---
@@ -296,10 +620,15 @@ def main():
     # Start the sender/aggregation thread
     sender_thread = threading.Thread(target=periodic_sender, daemon=True)
     sender_thread.start()
+
+    # Start the load monitor that switches handler() into sampling under overload
+    if SAMPLING_ENABLED:
+        load_thread = threading.Thread(target=load_monitor, daemon=True)
+        load_thread.start()
     
     try:
-        # Start sniffing (handler checks capture_active flag)
-        sniff(iface=CAPTURE_IFACE, prn=handler, store=0)
+        # Start capturing (capture_frame checks capture_active flag)
+        capture_loop()
     except Exception as e:
         print(f"[ERROR] Sniffing failed: {e}")
         print("Make sure:")
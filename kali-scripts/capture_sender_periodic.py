@@ -11,6 +11,7 @@ import threading
 import time
 import json
 import os
+from upload_encoding import DeltaEncoder, make_thresholds
 
 # ----- CONFIG -----
 SUPABASE_URL = "https://zecylmrmutyhibqwnjps.supabase.co"
@@ -18,12 +19,16 @@ SUPABASE_KEY = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJpc3MiOiJzdXBhYmFzZSIsInJ
 CAPTURE_IFACE = "wlan0mon"
 CAPTURE_WINDOW = 30          # seconds per batch
 SEND_INTERVAL = 30           # seconds per send (same as window)
+UPLOAD_BATCH = True          # one gzip request per window, unchanged devices sent by id only
+KEYFRAME_INTERVAL = 10       # windows between full uploads
+DELTA_RSSI_DB = 3.0          # RSSI change that forces a resend
 # ------------------
 
 lock = threading.Lock()
 packet_buffer = {}  # device_id -> list of packets (RSSI, AP, timestamp)
 capture_active = False
 network_error_logged = False  # Track if we've already logged network errors
+upload_encoder = DeltaEncoder(KEYFRAME_INTERVAL, make_thresholds(DELTA_RSSI_DB))
 
 def parse_rssi(pkt):
     """Parse RSSI from packet - try multiple methods"""
@@ -119,6 +124,58 @@ def send_to_supabase(payload):
     except Exception as e:
         print("[SEND] Exception:", e)
 
+def post_batch(body):
+    """POST a gzip batch body; returns the JSON response or None on failure"""
+    headers = {
+        'Content-Type': 'application/json',
+        'Content-Encoding': 'gzip',
+        'Authorization': f'Bearer {SUPABASE_KEY}'
+    }
+    
+    resp = requests.post(f"{SUPABASE_URL}/functions/v1/wifi-capture/batch", data=body, headers=headers, timeout=10)
+    if resp.status_code != 200:
+        print(f"[SEND] FAIL {resp.status_code}: {resp.text}")
+        return None
+    return resp.json()
+
+def send_batch_to_supabase(payloads):
+    """Send one gzip batch for the window; unchanged devices go by id only"""
+    try:
+        body, info = upload_encoder.encode(payloads)
+        result = post_batch(body)
+        if result is None:
+            upload_encoder.reset()
+            return
+        kind = "keyframe" if info["keyframe"] else "delta"
+        print(f"[SEND] OK → batch ({kind}): {info['full']} full, {info['unchanged']} unchanged, {info['gzip_bytes']} B gzip")
+
+        # Server had no stored row for these; resend them in full for this window
+        missing = set(result.get('missing') or [])
+        if missing:
+            body, info = upload_encoder.encode_resend([p for p in payloads if p["device_id"] in missing])
+            if post_batch(body) is None:
+                upload_encoder.reset()
+                return
+            print(f"[SEND] OK → resent {info['full']} devices unknown to server")
+    except Exception as e:
+        print("[SEND] Exception:", e)
+        upload_encoder.reset()
+
+def flush_buffer():
+    """Build payloads for every buffered device and upload them"""
+    payloads = []
+    for device_id, recs in list(packet_buffer.items()):
+        payload = send_captures(device_id, recs)
+        if payload:
+            payloads.append(payload)
+    if not payloads:
+        return
+    if UPLOAD_BATCH:
+        send_batch_to_supabase(payloads)
+    else:
+        for payload in payloads:
+            send_to_supabase(payload)
+
 def periodic_sender():
     """Flush packet_buffer every SEND_INTERVAL seconds when capture is active"""
     while True:
@@ -130,10 +187,7 @@ def periodic_sender():
             if not packet_buffer:
                 continue
             print(f"\n[SENDING] Processing {len(packet_buffer)} devices...")
-            for device_id, recs in list(packet_buffer.items()):
-                payload = send_captures(device_id, recs)
-                if payload:
-                    send_to_supabase(payload)
+            flush_buffer()
             packet_buffer.clear()
 
 def start_capture():
@@ -142,6 +196,7 @@ def start_capture():
     with lock:
         capture_active = True
         packet_buffer.clear()
+        upload_encoder.reset()
     print("[CAPTURE] Started WiFi capture - waiting for packets...")
 
 def stop_capture():
@@ -152,10 +207,7 @@ def stop_capture():
         # Send any remaining data before stopping
         if packet_buffer:
             print(f"[STOP] Sending final {len(packet_buffer)} devices...")
-            for device_id, recs in list(packet_buffer.items()):
-                payload = send_captures(device_id, recs)
-                if payload:
-                    send_to_supabase(payload)
+            flush_buffer()
             packet_buffer.clear()
     print("[CAPTURE] Stopped WiFi capture")
 
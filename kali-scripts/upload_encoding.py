@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# upload_encoding.py – compressed, delta-encoded batch uploads for the capture scripts
+# Purpose: Send one gzip JSON batch per window, carrying full summaries only for devices
+#          that moved beyond thresholds since they were last sent (plus periodic keyframes)
+#
+# Batch body (before gzip), POSTed to wifi-capture/batch:
+#   {"v": 1, "keyframe": bool, "window": n,
+#    "devices": [<full per-device payload>, ...],
+#    "unchanged": ["<device_id>", ...]}
+# The edge function re-inserts the last stored capture for each "unchanged" device and
+# returns {"missing": [...]} for ids it has no state for; the sender resends those in
+# full straight away (encode_resend) so the window still gets a row for them.
+#
+# batch_stub_server.py emulates the edge side for local round-trip testing.
+
+import gzip
+import json
+
+BATCH_FORMAT_VERSION = 1
+
+# Recomputed from the wall clock every window and not stored by the edge function;
+# keyframes refresh them, so they never force a resend on their own
+IGNORED_FIELDS = frozenset({"login_hour", "weekday", "start_minute_of_day", "sample_rate"})
+
+def make_thresholds(rssi_db=3.0, count_rel=0.5):
+    """Per-field resend thresholds as (slack, rel): a field moved when |new - old| > max(slack, rel * |old|).
+
+    Frame counts are noisy even for an idle phone (3 frames one window, 8 the next),
+    so count fields get a count-sized slack on top of a wide relative band.
+    Numeric fields not listed here are compared exactly (e.g. ap_switches).
+    """
+    return {
+        "rssi": (rssi_db, 0.0),
+        "rssi_mean": (rssi_db, 0.0),
+        "rssi_std": (rssi_db, 0.0),
+        "duration_total": (5.0, 0.2),      # seconds
+        "frame_count": (20, count_rel),
+        "data_frames": (20, count_rel),
+        "mgmt_frames": (20, count_rel),
+        "frag_count": (10, count_rel),
+        "invalid_rssi_count": (10, count_rel),
+        "bytes_total": (20000, count_rel),  # bytes
+    }
+
+class DeltaEncoder:
+    """Tracks the last summary sent per device and builds gzip batch bodies"""
+
+    def __init__(self, keyframe_interval=10, thresholds=None):
+        if keyframe_interval < 1:
+            raise ValueError(f"keyframe_interval must be >= 1, got {keyframe_interval}")
+        self.keyframe_interval = keyframe_interval  # windows between full-state uploads
+        self.thresholds = thresholds if thresholds is not None else make_thresholds()
+        self.last_sent = {}  # device_id -> payload last sent in full
+        self.window = 0
+
+    def reset(self):
+        """Forget sent state so the next batch is a keyframe"""
+        self.last_sent.clear()
+        self.window = 0
+
+    def encode_resend(self, payloads):
+        """Build a follow-up body carrying these payloads in full for the window just encoded"""
+        for payload in payloads:
+            self.last_sent[payload["device_id"]] = payload
+        return self._build(False, max(self.window - 1, 0), payloads, [])
+
+    def changed(self, prev, cur):
+        """True if any field of cur moved beyond its threshold relative to prev"""
+        for key, value in cur.items():
+            if key in IGNORED_FIELDS:
+                continue
+            old = prev.get(key)
+            rule = self.thresholds.get(key)
+            numeric = (isinstance(value, (int, float)) and isinstance(old, (int, float))
+                       and not isinstance(value, bool))
+            if rule is None or not numeric:
+                if value != old:
+                    return True
+                continue
+            slack, rel = rule
+            if abs(value - old) > max(slack, rel * abs(old)):
+                return True
+        return False
+
+    def encode(self, payloads):
+        """Build the gzip batch body for this window's payloads.
+
+        Returns (body, info) where info holds counts and raw/compressed sizes for logging.
+        """
+        keyframe = self.window % self.keyframe_interval == 0
+        devices = []
+        unchanged = []
+        for payload in payloads:
+            device_id = payload["device_id"]
+            prev = self.last_sent.get(device_id)
+            if keyframe or prev is None or self.changed(prev, payload):
+                devices.append(payload)
+                self.last_sent[device_id] = payload
+            else:
+                unchanged.append(device_id)
+
+        # Devices absent this window are resent in full when they reappear
+        present = {p["device_id"] for p in payloads}
+        for device_id in list(self.last_sent):
+            if device_id not in present:
+                del self.last_sent[device_id]
+
+        body, info = self._build(keyframe, self.window, devices, unchanged)
+        self.window += 1
+        return body, info
+
+    def _build(self, keyframe, window, devices, unchanged):
+        raw = json.dumps({
+            "v": BATCH_FORMAT_VERSION,
+            "keyframe": keyframe,
+            "window": window,
+            "devices": devices,
+            "unchanged": unchanged
+        }, separators=(",", ":")).encode("utf-8")
+        body = gzip.compress(raw, compresslevel=6)
+
+        info = {
+            "keyframe": keyframe,
+            "full": len(devices),
+            "unchanged": len(unchanged),
+            "raw_bytes": len(raw),
+            "gzip_bytes": len(body)
+        }
+        return body, info
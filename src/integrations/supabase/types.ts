@@ -210,26 +210,47 @@ export type Database = {
       periodic_captures: {
         Row: {
           ap_id: string
+          bytes_total: number | null
           created_at: string
+          data_frames: number | null
           device_id: string
+          frag_count: number | null
+          frame_count: number | null
           id: string
+          invalid_rssi_count: number | null
+          mgmt_frames: number | null
           rssi: number
+          rssi_std: number | null
           timestamp: string
         }
         Insert: {
           ap_id: string
+          bytes_total?: number | null
           created_at?: string
+          data_frames?: number | null
           device_id: string
+          frag_count?: number | null
+          frame_count?: number | null
           id?: string
+          invalid_rssi_count?: number | null
+          mgmt_frames?: number | null
           rssi?: number
+          rssi_std?: number | null
           timestamp?: string
         }
         Update: {
           ap_id?: string
+          bytes_total?: number | null
           created_at?: string
+          data_frames?: number | null
           device_id?: string
+          frag_count?: number | null
+          frame_count?: number | null
           id?: string
+          invalid_rssi_count?: number | null
+          mgmt_frames?: number | null
           rssi?: number
+          rssi_std?: number | null
           timestamp?: string
         }
         Relationships: []
@@ -354,6 +375,24 @@ export type Database = {
           updated_at: string
         }[]
       }
+      get_latest_periodic_captures: {
+        Args: { device_ids: string[] }
+        Returns: {
+          ap_id: string
+          bytes_total: number | null
+          created_at: string
+          data_frames: number | null
+          device_id: string
+          frag_count: number | null
+          frame_count: number | null
+          id: string
+          invalid_rssi_count: number | null
+          mgmt_frames: number | null
+          rssi: number
+          rssi_std: number | null
+          timestamp: string
+        }[]
+      }
       set_capture_control:
         | { Args: { start_capture: boolean }; Returns: Json }
         | {
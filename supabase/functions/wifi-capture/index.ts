@@ -22,6 +22,32 @@ interface CaptureData {
   login_hour?: number;
   weekday?: number;
   start_minute_of_day?: number;
+  // Frame accounting from capture_sender.py, stored per window (frag/bytes summed in process)
+  frame_count?: number;
+  data_frames?: number;
+  mgmt_frames?: number;
+  sample_rate?: number;
+}
+
+interface CaptureBatch {
+  v: number;
+  keyframe: boolean;
+  window: number;
+  devices: CaptureData[];
+  unchanged: string[];
+}
+
+interface PeriodicCaptureRow {
+  device_id: string;
+  ap_id: string;
+  rssi: number;
+  rssi_std: number | null;
+  invalid_rssi_count: number | null;
+  frag_count: number | null;
+  bytes_total: number | null;
+  frame_count: number | null;
+  data_frames: number | null;
+  mgmt_frames: number | null;
 }
 
 interface ProcessedRecord {
@@ -49,6 +75,22 @@ function hashMac(mac: string): string {
     .join('');
 }
 
+// Parse a JSON request body, decompressing it first if it is gzip (magic bytes 1f 8b)
+async function readJsonBody(req: Request): Promise<unknown> {
+  const bytes = new Uint8Array(await req.arrayBuffer());
+  if (bytes.length >= 2 && bytes[0] === 0x1f && bytes[1] === 0x8b) {
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+    return await new Response(stream).json();
+  }
+  return JSON.parse(new TextDecoder().decode(bytes));
+}
+
+function isCaptureBatch(value: unknown): value is CaptureBatch {
+  if (typeof value !== 'object' || value === null) return false;
+  const batch = value as Record<string, unknown>;
+  return Array.isArray(batch.devices) && Array.isArray(batch.unchanged);
+}
+
 // Python microservice URL for ONNX model inference
 const ANOMALY_SERVICE_URL = Deno.env.get('ANOMALY_SERVICE_URL') || 'http://localhost:5000';
 
@@ -161,7 +203,15 @@ serve(async (req) => {
           .insert({
             device_id: data.device_id,
             ap_id: data.ap_id || 'DefaultAP',
-            rssi: data.rssi || -99,
+            // capture_sender.py sends a per-window rssi_mean rather than a single rssi
+            rssi: data.rssi ?? data.rssi_mean ?? -99,
+            rssi_std: data.rssi_std ?? null,
+            invalid_rssi_count: data.invalid_rssi_count ?? null,
+            frag_count: data.frag_count ?? null,
+            bytes_total: data.bytes_total ?? null,
+            frame_count: data.frame_count ?? null,
+            data_frames: data.data_frames ?? null,
+            mgmt_frames: data.mgmt_frames ?? null,
             timestamp,
           });
 
@@ -187,6 +237,102 @@ serve(async (req) => {
       );
     }
 
+    // ========== BATCH ENDPOINT ==========
+    // Gzip JSON batch from the capture scripts (see kali-scripts/upload_encoding.py):
+    // full payloads for devices that changed, ids only for unchanged devices.
+    if (action === 'batch' && req.method === 'POST') {
+      const batch = await readJsonBody(req);
+      if (!isCaptureBatch(batch)) {
+        return new Response(
+          JSON.stringify({ error: 'Invalid batch data' }),
+          { status: 400, headers: { ...corsHeaders, 'Content-Type': 'application/json' } }
+        );
+      }
+      const timestamp = new Date().toISOString();
+      const devices = batch.devices.filter((d) => d.device_id);
+      const unchanged = batch.unchanged.filter((id) => typeof id === 'string');
+
+      const rows = devices.map((d) => ({
+        device_id: d.device_id!,
+        ap_id: d.ap_id || 'DefaultAP',
+        rssi: d.rssi ?? d.rssi_mean ?? -99,
+        rssi_std: d.rssi_std ?? null,
+        invalid_rssi_count: d.invalid_rssi_count ?? null,
+        frag_count: d.frag_count ?? null,
+        bytes_total: d.bytes_total ?? null,
+        frame_count: d.frame_count ?? null,
+        data_frames: d.data_frames ?? null,
+        mgmt_frames: d.mgmt_frames ?? null,
+        timestamp,
+      }));
+
+      // Expand unchanged devices from their most recent stored capture
+      const missing: string[] = [];
+      if (unchanged.length > 0) {
+        // One row per device (DISTINCT ON), so the read stays bounded by the batch size
+        const { data: previous, error: prevError } = await supabaseClient
+          .rpc('get_latest_periodic_captures', { device_ids: unchanged });
+
+        if (prevError) {
+          console.error('[batch] Fetch previous error:', prevError);
+        }
+
+        const latest = new Map<string, PeriodicCaptureRow>();
+        for (const row of (previous || []) as PeriodicCaptureRow[]) {
+          latest.set(row.device_id, row);
+        }
+        for (const deviceId of unchanged) {
+          const prev = latest.get(deviceId);
+          if (prev) {
+            rows.push({
+              device_id: deviceId,
+              ap_id: prev.ap_id,
+              rssi: prev.rssi,
+              rssi_std: prev.rssi_std,
+              invalid_rssi_count: prev.invalid_rssi_count,
+              frag_count: prev.frag_count,
+              bytes_total: prev.bytes_total,
+              frame_count: prev.frame_count,
+              data_frames: prev.data_frames,
+              mgmt_frames: prev.mgmt_frames,
+              timestamp,
+            });
+          } else {
+            missing.push(deviceId);
+          }
+        }
+      }
+
+      if (rows.length > 0) {
+        const { error: insertError } = await supabaseClient
+          .from('periodic_captures')
+          .insert(rows);
+
+        if (insertError) {
+          console.error('[batch] Insert error:', insertError);
+          return new Response(
+            JSON.stringify({ error: insertError.message }),
+            { status: 500, headers: { ...corsHeaders, 'Content-Type': 'application/json' } }
+          );
+        }
+      }
+
+      console.log(
+        `[batch] ${batch.keyframe ? 'Keyframe' : 'Delta'} window ${batch.window}: ` +
+        `${devices.length} full, ${unchanged.length - missing.length} expanded, ${missing.length} missing`
+      );
+
+      return new Response(
+        JSON.stringify({
+          message: 'Batch recorded',
+          inserted: rows.length,
+          expanded: unchanged.length - missing.length,
+          missing,
+        }),
+        { headers: { ...corsHeaders, 'Content-Type': 'application/json' } }
+      );
+    }
+
     // ========== PROCESS ENDPOINT ==========
     if (action === 'process' && req.method === 'POST') {
       console.log('[process] Aggregating and processing captures...');
@@ -278,21 +424,39 @@ serve(async (req) => {
         const lastSeen = new Date(group[group.length - 1].timestamp);
         const duration = (lastSeen.getTime() - firstSeen.getTime()) / 1000;
 
-        const rssiValues = group.map(g => g.rssi || -99);
-        const avgRssi = rssiValues.reduce((a, b) => a + b, 0) / rssiValues.length;
+        // Rows from capture_sender.py are per-window summaries: weight each by its
+        // frame count and pool its within-window std. Single-RSSI rows weigh 1 with std 0.
+        const weights = group.map(g => Number(g.frame_count) || 1);
+        const weightTotal = weights.reduce((a, b) => a + b, 0);
+        const rssiValues = group.map(g => Number(g.rssi) || -99);
+        const avgRssi = rssiValues.reduce((sum, val, i) => sum + weights[i] * val, 0) / weightTotal;
         const rssiStd = Math.sqrt(
-          rssiValues.reduce((sum, val) => sum + Math.pow(val - avgRssi, 2), 0) / rssiValues.length
+          group.reduce((sum, g, i) =>
+            sum + weights[i] * (Math.pow(Number(g.rssi_std) || 0, 2) + Math.pow(rssiValues[i] - avgRssi, 2)), 0
+          ) / weightTotal
         );
+        const invalidCounts = group.filter(g => g.invalid_rssi_count !== null && g.invalid_rssi_count !== undefined);
+        const invalidRssiCount = invalidCounts.length > 0
+          ? invalidCounts.reduce((sum, g) => sum + g.invalid_rssi_count, 0)
+          : Math.max(0, 10 - group.length);
+
+        // Frame accounting is only present for rows from capture_sender.py;
+        // fall back to the sample count / 0 used before it was tracked
+        const accounted = group.filter(g => g.frag_count !== null && g.frag_count !== undefined);
+        const fragCount = accounted.length > 0
+          ? accounted.reduce((sum, g) => sum + g.frag_count, 0)
+          : group.length;
+        const bytesTotal = group.reduce((sum, g) => sum + (Number(g.bytes_total) || 0), 0);
 
         // Run ONNX anomaly detection
         const features = {
           duration_total: duration,
           ap_switches: 0, // We don't track AP switches in this simplified version
-          frag_count: group.length, // Use sample count as fragment count
-          bytes_total: 0, // Not tracked yet
+          frag_count: fragCount,
+          bytes_total: bytesTotal,
           rssi_mean: avgRssi,
           rssi_std: rssiStd,
-          invalid_rssi_count: Math.max(0, 10 - group.length),
+          invalid_rssi_count: invalidRssiCount,
           login_hour: firstSeen.getHours(),
           weekday: firstSeen.getDay(),
           start_minute_of_day: firstSeen.getHours() * 60 + firstSeen.getMinutes(),
@@ -0,0 +1,5 @@
+-- Per-window frame accounting from capture_sender.py, aggregated by wifi-capture/process
+ALTER TABLE public.periodic_captures
+  ADD COLUMN IF NOT EXISTS frag_count INTEGER,
+  ADD COLUMN IF NOT EXISTS bytes_total BIGINT,
+  ADD COLUMN IF NOT EXISTS frame_count INTEGER;
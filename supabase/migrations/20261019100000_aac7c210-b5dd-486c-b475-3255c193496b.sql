@@ -0,0 +1,4 @@
+-- Per-window RSSI spread and invalid count (sampling-corrected by capture_sender.py)
+ALTER TABLE public.periodic_captures
+  ADD COLUMN IF NOT EXISTS rssi_std NUMERIC,
+  ADD COLUMN IF NOT EXISTS invalid_rssi_count INTEGER;
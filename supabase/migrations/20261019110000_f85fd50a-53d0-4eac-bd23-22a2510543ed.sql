@@ -0,0 +1,20 @@
+-- Latest periodic capture per device, used by wifi-capture/batch to expand unchanged devices
+CREATE INDEX IF NOT EXISTS idx_periodic_captures_device_timestamp
+  ON public.periodic_captures(device_id, timestamp DESC);
+
+CREATE OR REPLACE FUNCTION public.get_latest_periodic_captures(device_ids text[])
+RETURNS SETOF public.periodic_captures
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path TO 'public'
+AS $$
+  SELECT DISTINCT ON (pc.device_id) pc.*
+  FROM public.periodic_captures pc
+  WHERE pc.device_id = ANY(device_ids)
+  ORDER BY pc.device_id, pc.timestamp DESC;
+$$;
+
+-- Only the edge function (service role) calls this
+REVOKE EXECUTE ON FUNCTION public.get_latest_periodic_captures(text[]) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION public.get_latest_periodic_captures(text[]) TO service_role;
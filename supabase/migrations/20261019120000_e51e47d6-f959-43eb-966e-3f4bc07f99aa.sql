@@ -0,0 +1,4 @@
+-- Data vs management frame counts per window from capture_sender.py
+ALTER TABLE public.periodic_captures
+  ADD COLUMN IF NOT EXISTS data_frames INTEGER,
+  ADD COLUMN IF NOT EXISTS mgmt_frames INTEGER;